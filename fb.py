@@ -2,30 +2,44 @@
 
 from __future__ import print_function
 import argparse
+import base64
 import collections
 import contextlib
+import ctypes
+import ctypes.util
 import datetime
 import errno
+import fcntl
 import getpass
 import gzip
+import hashlib
 import json
 import locale
 import lzma
 import os
+import pickle
 import pycurl
 import re
+import select
 import shutil
 import signal
+import struct
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import typing
 import xdg.BaseDirectory
 
 from io import BytesIO
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 X11_CLIPBOARD_CMD = 'xclip'
 WAYLAND_CLIPBOARD_CMD = 'wl-copy'
@@ -48,9 +62,44 @@ def chunker(seq, size):
 # Source: http://stackoverflow.com/a/8356620
 def print_table(table):
     col_width = [max(len(x) for x in col) for col in zip(*table)]
-    for line in table:
-        print("| " + " | ".join("{:{}}".format(x, col_width[i])
-                                for i, x in enumerate(line)) + " |")
+    sys.stdout.write("".join("| " + " | ".join("{:{}}".format(x, col_width[i])
+                                               for i, x in enumerate(line)) + " |\n"
+                             for line in table))
+
+class Output:
+    """
+    Write machine readable results in the format selected with --output.
+
+    With "json" the records form one array that is written element by
+    element, with "ndjson" every record is written as a line of its own.
+    In "text" mode nothing is written here; callers print their usual
+    human readable output instead.
+    """
+    def __init__(self, format, stream=None):
+        self.format = format
+        self.stream = stream if stream is not None else sys.stdout
+        self.count = 0
+
+    @property
+    def text(self):
+        return self.format == "text"
+
+    def emit(self, record):
+        if self.format == "json":
+            self.stream.write("[\n" if self.count == 0 else ",\n")
+            self.stream.write(json.dumps(record))
+        elif self.format == "ndjson":
+            self.stream.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def flush(self):
+        if not self.text:
+            self.stream.flush()
+
+    def close(self):
+        if self.format == "json":
+            self.stream.write("[]\n" if self.count == 0 else "\n]\n")
+        self.flush()
 
 # Source: http://stackoverflow.com/a/14981125
 def eprint(*args, **kwargs):
@@ -80,23 +129,276 @@ def make_temp_directory():
     finally:
         shutil.rmtree(temp_dir)
 
+# Every position in a file is marked or not depending on a hash of the
+# CDC_WINDOW bytes ending there. The hash of two bytes XORs a random byte for
+# each of them; it is extended to windows of 4, 8 and 16 bytes by XORing it
+# with a random function of the hash of the preceding half. CDC_MARKS maps
+# the result to a mark so that even data with a small alphabet is marked
+# about half of the time. All of this is done with bytes.translate() and
+# integer operations, which run at C speed.
+CDC_WINDOW = 16
+CDC_TABLES = [bytes(hashlib.sha256(bytes([j, b])).digest()[0] for b in range(256)) for j in range(5)]
+CDC_MARKS = bytes(hashlib.sha256(bytes([b])).digest()[0] & 1 for b in range(256))
+
+def _xor_bytes(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+def window_marks(data):
+    """
+    Returns:
+        Marks (0 or 1) of the positions of data except for the first
+        CDC_WINDOW - 1 ones, which are only used as context.
+    """
+    h = _xor_bytes(data[1:].translate(CDC_TABLES[0]), data[:-1].translate(CDC_TABLES[1]))
+    for table, shift in zip(CDC_TABLES[2:], (2, 4, 8)):
+        h = _xor_bytes(h[shift:], h[:-shift].translate(table))
+    return h.translate(CDC_MARKS)
+
+def content_defined_chunks(fh, minsize, avgsize, maxsize, total=None, blocksize=4*1024*1024):
+    """
+    Split the content of a file into content defined chunks.
+
+    Chunk boundaries are placed after runs of marked positions (see
+    window_marks()), so they only depend on the content around them and
+    inserting or removing data only changes the chunks next to the
+    modification.
+
+    Args:
+        fh: File object opened in binary mode
+        minsize, avgsize, maxsize: Chunk size limits and the size to aim for
+        total: Optional hash object that is updated with the whole content
+    Yields:
+        Chunks as dicts with "offset", "size" and "sha256" as soon as their
+        end has been found
+    """
+    # a run of n marked positions occurs about every 2^(n+1) bytes
+    run = max(1, (avgsize - minsize).bit_length() - 2)
+    pattern = b'\x01' * run
+
+    chunk = hashlib.sha256()
+    chunksize = 0
+    offset = 0
+    context = bytes(CDC_WINDOW - 1)
+    tail = b''
+
+    while True:
+        block = fh.read(blocksize)
+        if not block:
+            break
+        if total is not None:
+            total.update(block)
+
+        # marks[i + len(tail)] belongs to block[i]
+        data = context + block
+        marks = tail + window_marks(data)
+        context = data[len(data) - CDC_WINDOW + 1:]
+        del data
+
+        pos = 0
+        while pos < len(block):
+            first = pos + minsize - chunksize
+            last = pos + maxsize - chunksize
+            found = marks.find(pattern, max(0, first + len(tail) - run), min(last, len(block)) + len(tail))
+            if found >= 0:
+                cut = found + run - len(tail)
+            elif last <= len(block):
+                cut = last
+            else:
+                chunk.update(block[pos:])
+                chunksize += len(block) - pos
+                break
+
+            chunk.update(block[pos:cut])
+            chunksize += cut - pos
+            yield {"offset": offset, "size": chunksize, "sha256": chunk.hexdigest()}
+            offset += chunksize
+            chunk = hashlib.sha256()
+            chunksize = 0
+            pos = cut
+
+        tail = marks[len(marks) - run + 1:] if run > 1 else b''
+
+    if chunksize > 0:
+        yield {"offset": offset, "size": chunksize, "sha256": chunk.hexdigest()}
+
 class APIException(Exception):
     def __init__(self, message, error_id):
         super().__init__(message)
         self.error_id = error_id
 
+class JSONStreamParser:
+    """
+    Incrementally parse an API response while it is being downloaded.
+
+    Members of the objects below "data" that have a handler are built one at a
+    time and passed to the handler as soon as they are complete so the whole
+    response never has to be kept in memory.
+    """
+    FIELDS = ('status', 'message', 'error_id')
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.fields = {}
+        self.error = None
+        self.current = None
+        self.events = ijson.sendable_list()
+        self.coro = ijson.parse_coro(self.events)
+
+    def write(self, chunk):
+        try:
+            self.coro.send(chunk)
+        except ijson.JSONError as e:
+            self.error = e
+            # abort the transfer
+            return 0
+
+        for prefix, event, value in self.events:
+            self._event(prefix, event, value)
+        del self.events[:]
+
+    def _event(self, prefix, event, value):
+        if self.current is not None:
+            callback, base, key, builder = self.current
+            if prefix != base:
+                builder.event(event, value)
+                return
+            callback(key, builder.value)
+            self.current = None
+
+        if event == 'map_key' and prefix.startswith('data.') and prefix[5:] in self.handlers:
+            self.current = (self.handlers[prefix[5:]], prefix, value, ijson.ObjectBuilder())
+        elif prefix in self.FIELDS:
+            self.fields[prefix] = value
+
+    def close(self):
+        if self.error is None:
+            try:
+                self.coro.close()
+            except ijson.JSONError as e:
+                self.error = e
+
+        if self.error is not None:
+            raise APIException("Invalid response: %s" % self.error, "client-internal/invalid-response")
+
+        if self.fields.get("status") == "error":
+            raise APIException("Request failed: %s" % self.fields.get("message"), self.fields.get("error_id"))
+        if self.fields.get("status") != "success":
+            raise APIException("Request failed or invalid response", "client-internal/invalid-response")
+
+class BandwidthLimiter:
+    """
+    Token bucket that limits the combined bandwidth of all transfers using it.
+
+    If a state file is given, the bucket is stored there and shared with all
+    processes that use the same file.
+    """
+    def __init__(self, rate, burst=0, statefile=None):
+        self.rate = rate
+        self.burst = burst if burst > 0 else rate
+        self.statefile = statefile
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.timestamp = time.time()
+
+    def _take(self, tokens, timestamp, amount):
+        """
+        Refill the bucket for the time passed since timestamp and remove
+        amount tokens.
+
+        Returns:
+            Tuple of the new token count and timestamp
+        """
+        now = time.time()
+        tokens = min(self.burst, tokens + max(0, now - timestamp) * self.rate)
+        return tokens - amount, now
+
+    def _consume_shared(self, amount):
+        fd = os.open(self.statefile, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        with open(fd, 'r+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            try:
+                tokens, timestamp = [float(x) for x in fh.read().split()]
+            except ValueError:
+                tokens, timestamp = self.burst, time.time()
+
+            tokens, timestamp = self._take(tokens, timestamp, amount)
+
+            fh.seek(0)
+            fh.truncate()
+            fh.write("%f %f\n" % (tokens, timestamp))
+        return tokens
+
+    def consume(self, amount):
+        """
+        Account for amount transferred bytes and sleep until the bucket
+        allows them.
+        """
+        if amount <= 0:
+            return
+
+        if self.statefile is not None:
+            tokens = self._consume_shared(amount)
+        else:
+            with self.lock:
+                self.tokens, self.timestamp = self._take(self.tokens, self.timestamp, amount)
+                tokens = self.tokens
+
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+    def transfer(self):
+        """
+        Create a callback for a single transfer.
+
+        The returned function takes the number of bytes transferred so far
+        and consumes the difference to the previous call.
+        """
+        last = [0]
+        def update(total):
+            self.consume(total - last[0])
+            last[0] = total
+        return update
+
+    @staticmethod
+    def get_statefile():
+        """
+        Returns:
+            Path of the state file shared by all processes of this user
+        """
+        if 'XDG_RUNTIME_DIR' in os.environ:
+            statedir = os.path.join(os.environ['XDG_RUNTIME_DIR'], "fb-client")
+        else:
+            statedir = os.path.join(tempfile.gettempdir(), "fb-client-%d" % os.getuid())
+
+        try:
+            os.makedirs(statedir, mode=0o700, exist_ok=True)
+            st = os.lstat(statedir)
+        except OSError as e:
+            raise APIException("Failed to create rate limit state directory: %s" % e,
+                    "client-internal/ratelimit-state")
+        # someone else may have created it first in a shared /tmp
+        if not os.path.isdir(statedir) or os.path.islink(statedir) or st.st_uid != os.getuid():
+            raise APIException("Rate limit state directory %s is not a directory owned by you" % statedir,
+                    "client-internal/ratelimit-state")
+        return os.path.join(statedir, "ratelimit")
+
 class CURLWrapper:
-    def __init__(self, config, args):
+    def __init__(self, config, args, limiter=None):
         c = pycurl.Curl()
         c.setopt(c.USERAGENT, config['useragent'])
-        c.setopt(c.HTTPHEADER, [
+        self.headers = [
             "Expect:",
             "Accept: application/json",
-            ])
+            ]
+        c.setopt(c.HTTPHEADER, self.headers)
 
         if config["debug"]:
             c.setopt(c.VERBOSE, 1)
 
+        c.setopt(c.CONNECTTIMEOUT, config["connect_timeout"])
+        c.setopt(c.TIMEOUT, config["timeout"])
+
         self.config = config
         self.args = args
         self.curl = c
@@ -105,6 +407,11 @@ class CURLWrapper:
         else:
             self.post = []
         self.progressBar = ProgressBar()
+        self.showProgress = False
+        self.limiter = limiter
+        if limiter is not None:
+            # the limiter is driven by the progress callback
+            c.setopt(c.NOPROGRESS, 0)
         self.serverConfig = None
 
     def __add_post(self, data):
@@ -119,7 +426,7 @@ class CURLWrapper:
 
     def getServerConfig(self):
         if self.serverConfig is None:
-            self.serverConfig = CURLWrapper(self.config, self.args).send_get("/file/get_config")
+            self.serverConfig = CURLWrapper(self.config, self.args, self.limiter).send_get("/file/get_config")
         return self.serverConfig
 
     def getApiUrl(self):
@@ -128,12 +435,14 @@ class CURLWrapper:
         else:
             return self.config["pastebin"]+"/api/v2.0.0"
 
-    def upload_files(self, files):
+    def upload_files(self, files, callback=None):
         """
         Upload files if f.should_upload() for f in files is true.
 
         Args:
             files: List of File objects
+            callback: Function called without arguments after each request
+                once the IDs of its files have been set
         Returns:
             List of updated File objects
         """
@@ -163,7 +472,8 @@ class CURLWrapper:
                 if  filesize > self.config["warnsize"]:
                     self.getServerConfig()
                     if filesize > self.serverConfig["upload_max_size"]:
-                        raise APIException("File too big: %s" % (file.path), "client-internal/file-too-big")
+                        raise APIException("File too big: %s (use --split to upload it in parts)" % (file.path),
+                                "client-internal/file-too-big")
 
                 if self.serverConfig is not None and (currentChunkSize + filesize > self.serverConfig["request_max_size"] \
                         or len(chunks[currentChunk]) >= self.serverConfig["max_files_per_request"]):
@@ -184,10 +494,13 @@ class CURLWrapper:
                         part = self.mimepost.addpart()
                         part.name("file["+str(counter)+"]")
                         part.filedata(file.path.encode('utf-8'))
+                        if file.name is not None:
+                            part.filename(file.name.encode('utf-8'))
                     else:
-                        self.post.append(
-                            ("file["+str(counter)+"]", (pycurl.FORM_FILE, file.path.encode('utf-8')))
-                            )
+                        form = (pycurl.FORM_FILE, file.path.encode('utf-8'))
+                        if file.name is not None:
+                            form += (pycurl.FORM_FILENAME, file.name.encode('utf-8'))
+                        self.post.append(("file["+str(counter)+"]", form))
                 ret = self.send_post_progress("/file/upload", [])
                 rets["ids"] += ret["ids"]
                 rets["urls"] += ret["urls"]
@@ -196,6 +509,8 @@ class CURLWrapper:
                 for new_id, new_url, existing in zip(ret["ids"], ret["urls"], chunk):
                     existing.id = new_id
                     existing.url = new_url
+                if callback is not None:
+                    callback()
 
         self.progressBar.reset()
 
@@ -205,29 +520,63 @@ class CURLWrapper:
         self.curl.setopt(pycurl.URL, self.getApiUrl() + url)
         return self.perform()
 
-    def send_get_simple(self, url):
+    def send_get_simple(self, url, writefunction=None):
         self.curl.setopt(pycurl.URL, self.config["pastebin"] + "/" + url)
-        return self.perform_simple()
+        return self.perform_simple(writefunction)
+
+    def send_get_conditional(self, url, writefunction, headers=[], responseHeaders=None):
+        """
+        Like send_get_simple, but with additional request headers.
+
+        Args:
+            responseHeaders: Optional dict that is filled with the response
+                headers while they are received, e.g. to check them from
+                writefunction
+        Returns:
+            Tuple of the HTTP response code and a dict of the response
+            headers with lower case names
+        """
+        if responseHeaders is None:
+            responseHeaders = {}
+        def header(line):
+            name, sep, value = line.decode('iso-8859-1').partition(':')
+            if sep:
+                responseHeaders[name.strip().lower()] = value.strip()
+
+        self.curl.setopt(pycurl.HTTPHEADER, self.headers + headers)
+        self.curl.setopt(pycurl.HEADERFUNCTION, header)
+        try:
+            self.send_get_simple(url, writefunction)
+        finally:
+            self.curl.setopt(pycurl.HTTPHEADER, self.headers)
+            self.curl.setopt(pycurl.HEADERFUNCTION, lambda line: None)
+
+        return self.curl.getinfo(pycurl.HTTP_CODE), responseHeaders
 
     def send_post_progress(self, url, data = []):
         self.curl.setopt(pycurl.NOPROGRESS, 0)
         self.curl.setopt(self.curl.MAX_SEND_SPEED_LARGE, self.args.upload_speed)
-        ret = self.send_post(url, data)
-        self.curl.setopt(self.curl.MAX_SEND_SPEED_LARGE, 0)
-        self.curl.setopt(pycurl.NOPROGRESS, 1)
-        return ret
+        self.showProgress = True
+        try:
+            return self.send_post(url, data)
+        finally:
+            self.showProgress = False
+            self.curl.setopt(self.curl.MAX_SEND_SPEED_LARGE, 0)
+            if self.limiter is None:
+                self.curl.setopt(pycurl.NOPROGRESS, 1)
 
     def send_post_noauth(self, url, data = []):
         self.curl.setopt(pycurl.URL, self.getApiUrl() + url)
         self.curl.setopt(pycurl.POST, 1)
         self.__add_post(data)
 
-        ret = self.perform()
-        if hasattr(pycurl, 'MIMEPOST'):
-            self.mimepost = pycurl.CurlMime(self.curl)
-        else:
-            self.post = []
-        return ret
+        try:
+            return self.perform()
+        finally:
+            if hasattr(pycurl, 'MIMEPOST'):
+                self.mimepost = pycurl.CurlMime(self.curl)
+            else:
+                self.post = []
 
 
     def send_post(self, url, data = []):
@@ -244,37 +593,95 @@ class CURLWrapper:
                 self.post.append(("minimum-id-length", self.args.min_id_length))
 
         self.addAPIKey()
-        ret = self.perform()
-        if hasattr(pycurl, 'MIMEPOST'):
-            self.mimepost = pycurl.CurlMime(self.curl)
-        else:
-            self.post = []
-        return ret
+        try:
+            return self.perform()
+        finally:
+            if hasattr(pycurl, 'MIMEPOST'):
+                self.mimepost = pycurl.CurlMime(self.curl)
+            else:
+                self.post = []
+
+    def send_post_stream(self, url, handlers, data = []):
+        """
+        Send a POST request and stream members of the response data.
+
+        Args:
+            url: API endpoint
+            handlers: dict mapping keys of the response data (e.g. "items")
+                to callbacks that are called with (key, value) for every
+                member of that object as soon as it has been received
+            data: additional POST data
+        """
+        if ijson is None:
+            resp = self.send_post(url, data)
+            for name, callback in handlers.items():
+                # empty objects are sent as empty lists
+                for key, value in (resp[name] or {}).items():
+                    callback(key, value)
+            return
+
+        self.curl.setopt(pycurl.URL, self.getApiUrl() + url)
+        self.curl.setopt(pycurl.POST, 1)
+        self.__add_post(data)
+        self.addAPIKey()
+
+        parser = JSONStreamParser(handlers)
+        try:
+            self.perform_simple(parser.write)
+        except pycurl.error:
+            if parser.error is None:
+                raise
+        finally:
+            if hasattr(pycurl, 'MIMEPOST'):
+                self.mimepost = pycurl.CurlMime(self.curl)
+            else:
+                self.post = []
+        parser.close()
+
+        httpcode = self.curl.getinfo(pycurl.HTTP_CODE)
+        if httpcode != 200:
+            raise APIException("Invalid HTTP response code: %s" % httpcode, "client-internal/invalid-response")
 
     def addAPIKey(self):
         assert self.config['apikey']
         self.__add_post([{"apikey": self.config["apikey"]}])
 
-    def perform_simple(self):
-        b = BytesIO()
+    def perform_simple(self, writefunction=None):
+        """
+        Perform the request.
+
+        Args:
+            writefunction: Callback that receives the response body in chunks.
+                If None, the body is buffered and returned as a string.
+        """
+        b = None
+        if writefunction is None:
+            b = BytesIO()
+            writefunction = b.write
+
         if hasattr(pycurl, 'MIMEPOST'):
             self.curl.setopt(pycurl.MIMEPOST, self.mimepost)
         else:
             self.curl.setopt(pycurl.HTTPPOST, self.post)
-        self.curl.setopt(pycurl.WRITEFUNCTION, b.write)
+        self.curl.setopt(pycurl.WRITEFUNCTION, writefunction)
         # Use XFERINFOFUNCTION if available, otherwise fallback to PROGRESSFUNCTION
         progress_opt = getattr(pycurl, 'XFERINFOFUNCTION', pycurl.PROGRESSFUNCTION)
-        self.curl.setopt(progress_opt, self.progressBar.progress)
+        self.curl.setopt(progress_opt, self.progress_callback())
         self.curl.perform()
 
+        if b is None:
+            return None
+
+        response = b.getvalue()
         if self.config["debug"]:
-            print(b.getvalue())
+            eprint(response)
 
-        return b.getvalue().decode("utf-8")
+        return response.decode("utf-8")
 
     def perform(self):
-        response = self.perform_simple()
+        return self.check_response(self.perform_simple())
 
+    def check_response(self, response):
         try:
             result = json.loads(response)
         except ValueError:
@@ -292,7 +699,23 @@ class CURLWrapper:
 
         return result["data"]
 
-    def dl_file(self, url, path):
+    def progress_callback(self):
+        """
+        Create the progress callback for the next transfer which drives the
+        bandwidth limiter and the progress bar.
+        """
+        limit = None
+        if self.limiter is not None:
+            limit = self.limiter.transfer()
+
+        def progress(dltotal, dlnow, ultotal, ulnow):
+            if limit is not None:
+                limit(dlnow + ulnow)
+            if self.showProgress:
+                return self.progressBar.progress(dltotal, dlnow, ultotal, ulnow)
+        return progress
+
+    def create_download_handle(self, url):
         # TODO: this is duplicated in __init__ (well mostly)
         c = pycurl.Curl()
         c.setopt(c.USERAGENT, self.config['useragent'])
@@ -303,15 +726,479 @@ class CURLWrapper:
         if self.config["debug"]:
             c.setopt(c.VERBOSE, 1)
 
+        c.setopt(c.CONNECTTIMEOUT, self.config["connect_timeout"])
+        c.setopt(c.TIMEOUT, self.config["timeout"])
+
+        if self.limiter is not None:
+            c.setopt(c.NOPROGRESS, 0)
+            limit = self.limiter.transfer()
+            progress_opt = getattr(pycurl, 'XFERINFOFUNCTION', pycurl.PROGRESSFUNCTION)
+            c.setopt(progress_opt, lambda dltotal, dlnow, ultotal, ulnow: limit(dlnow + ulnow))
+
+        c.setopt(c.URL, url)
+        return c
+
+    def dl_file(self, url, path):
+        c = self.create_download_handle(url)
         outfp = open(path, 'wb')
         try:
-            c.setopt(c.URL, url)
             c.setopt(c.WRITEDATA, outfp)
             c.perform()
         finally:
             outfp.close()
             c.close()
 
+    def prepare_stream_upload(self, filename, size, readfunction):
+        """
+        Set up an upload request for a single file whose content is read
+        from a callback. The caller has to perform the request (e.g. in a
+        CurlMulti) and pass the response to check_response().
+
+        Args:
+            filename: File name to use for the upload
+            size: Exact size of the content
+            readfunction: Callback that returns the next bytes of the content
+        Returns:
+            BytesIO object that receives the response
+        """
+        if size > self.config["warnsize"]:
+            self.getServerConfig()
+            if size > self.serverConfig["upload_max_size"]:
+                raise APIException("File too big: %s" % (filename), "client-internal/file-too-big")
+
+        self.curl.setopt(pycurl.URL, self.getApiUrl() + "/file/upload")
+        self.curl.setopt(pycurl.POST, 1)
+
+        part = self.mimepost.addpart()
+        part.name("file[1]")
+        part.filename(filename)
+        part.data_cb(size, readfunction)
+        if self.args.min_id_length:
+            self.__add_post([{"minimum-id-length": self.args.min_id_length}])
+        self.addAPIKey()
+        self.curl.setopt(pycurl.MIMEPOST, self.mimepost)
+
+        b = BytesIO()
+        self.curl.setopt(pycurl.WRITEFUNCTION, b.write)
+        progress_opt = getattr(pycurl, 'XFERINFOFUNCTION', pycurl.PROGRESSFUNCTION)
+        self.curl.setopt(progress_opt, self.progress_callback())
+        return b
+
+    def upload_parts(self, path, filename, parts):
+        """
+        Upload byte ranges of a file as separate pastes. Up to
+        config["concurrency"] requests are performed at the same time.
+
+        Args:
+            path: Path of the file
+            filename: Base name for the uploads; parts are numbered
+            parts: Iterable of dicts with "offset" and "size". The next part
+                is only taken once a request can be started. The "id" and
+                "url" of the paste are added to them.
+        Returns:
+            List of the parts
+        """
+        self.getServerConfig()
+        multi = pycurl.CurlMulti()
+        pending = enumerate(parts)
+        nextPart = next(pending, None)
+        uploaded = []
+        running = {}
+
+        def reader(fh, size):
+            remaining = [size]
+            def read(*args):
+                data = fh.read(min(args[-1], remaining[0]))
+                remaining[0] -= len(data)
+                return data
+            return read
+
+        try:
+            while nextPart is not None or running:
+                while nextPart is not None and len(running) < self.config["concurrency"]:
+                    index, part = nextPart
+                    uploaded.append(part)
+                    fh = open(path, 'rb')
+                    fh.seek(part["offset"])
+                    upload = CURLWrapper(self.config, self.args, self.limiter)
+                    upload.serverConfig = self.serverConfig
+                    response = upload.prepare_stream_upload("%s.part%03d" % (filename, index + 1),
+                                                            part["size"], reader(fh, part["size"]))
+                    multi.add_handle(upload.curl)
+                    running[upload.curl] = (part, upload, response, fh)
+                    nextPart = next(pending, None)
+
+                while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                    pass
+
+                while True:
+                    queued, succeeded, failed = multi.info_read()
+                    for handle, code, errmsg in failed:
+                        raise pycurl.error(code, errmsg)
+                    for handle in succeeded:
+                        multi.remove_handle(handle)
+                        part, upload, response, fh = running.pop(handle)
+                        fh.close()
+                        ret = upload.check_response(response.getvalue().decode("utf-8"))
+                        part["id"] = ret["ids"][0]
+                        part["url"] = ret["urls"][0]
+                        handle.close()
+                    if queued == 0:
+                        break
+
+                if running:
+                    multi.select(1.0)
+        finally:
+            for part, upload, response, fh in running.values():
+                fh.close()
+
+        return uploaded
+
+class URLMirror:
+    """
+    Upload the content of a remote URL while it is still being downloaded.
+
+    The download is piped into the upload request through a bounded buffer.
+    Both transfers run in the caller's CurlMulti and pause each other while
+    the buffer is full or empty. The upload is started as soon as the size
+    of the content is known. If it is still unknown when the buffer is full
+    or streaming is disabled, the download is written to a file in tempdir
+    which can then be uploaded normally.
+    """
+    def __init__(self, curlw, url, filename, tempdir, buffersize, stream=True):
+        self.curlw = curlw
+        self.filename = filename
+        self.tempdir = tempdir
+        self.buffersize = buffersize
+        self.buffer = bytearray()
+
+        self.download = curlw.create_download_handle(url)
+        self.download.setopt(pycurl.WRITEFUNCTION, self._write)
+        self.downloadDone = False
+        self.downloadPaused = False
+
+        self.upload = None
+        self.uploadResponse = None
+        self.uploadPaused = False
+
+        self.outfp = None
+        self.file = None
+        if not stream:
+            self._open_file()
+
+    def _open_file(self):
+        # every mirror gets its own directory so equal file names don't clash
+        path = os.path.join(tempfile.mkdtemp(dir=self.tempdir), self.filename)
+        self.outfp = open(path, 'wb')
+        self.outfp.write(self.buffer)
+        self.buffer = bytearray()
+
+    def _write(self, data):
+        if self.outfp is not None:
+            self.outfp.write(data)
+            return
+        if len(self.buffer) >= self.buffersize:
+            # curl will hand us the same data again once we unpause
+            self.downloadPaused = True
+            return pycurl.WRITEFUNC_PAUSE
+        self.buffer += data
+
+    def _read(self, *args):
+        # the requested size is the last argument
+        size = args[-1]
+        if not self.buffer:
+            self.uploadPaused = True
+            return pycurl.READFUNC_PAUSE
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def handles(self):
+        handles = [self.download]
+        if self.upload is not None:
+            handles.append(self.upload.curl)
+        return handles
+
+    def update(self, multi):
+        """
+        Start the upload or fall back to a file once possible and unpause
+        transfers that can continue.
+
+        Returns:
+            True if something changed and the multi handle should be
+            performed again without waiting
+        """
+        changed = False
+        if self.upload is None and self.outfp is None:
+            if self.downloadDone:
+                size = len(self.buffer)
+            else:
+                # -1 until the headers have been received or if there is no Content-Length
+                size = int(self.download.getinfo(getattr(pycurl, 'CONTENT_LENGTH_DOWNLOAD_T', pycurl.CONTENT_LENGTH_DOWNLOAD)))
+
+            if size >= 0 and (self.buffer or self.downloadDone) and self._too_big(size):
+                # let --split upload it in parts once it has been downloaded
+                self._open_file()
+            elif size >= 0 and (self.buffer or self.downloadDone):
+                self.upload = CURLWrapper(self.curlw.config, self.curlw.args, self.curlw.limiter)
+                self.upload.serverConfig = self.curlw.serverConfig
+                self.uploadResponse = self.upload.prepare_stream_upload(self.filename, size, self._read)
+                multi.add_handle(self.upload.curl)
+                changed = True
+            elif self.downloadPaused:
+                self._open_file()
+
+        if self.downloadPaused and len(self.buffer) < self.buffersize:
+            self.downloadPaused = False
+            self.download.pause(pycurl.PAUSE_CONT)
+            changed = True
+
+        if self.uploadPaused and self.buffer:
+            self.uploadPaused = False
+            self.upload.curl.pause(pycurl.PAUSE_CONT)
+            changed = True
+
+        return changed
+
+    def _too_big(self, size):
+        """
+        Returns:
+            True if --split is used and the content has to be split
+        """
+        return self.curlw.args.split and size > self.curlw.config["warnsize"] \
+                and size > self.curlw.getServerConfig()["upload_max_size"]
+
+    def done(self, handle):
+        """
+        Handle the successful completion of one of our transfers.
+        """
+        if handle is self.download:
+            self.downloadDone = True
+            if self.outfp is not None:
+                self.outfp.close()
+                self.file = File(self.outfp.name)
+        else:
+            ret = self.upload.check_response(self.uploadResponse.getvalue().decode("utf-8"))
+            self.file = File(id=ret["ids"][0])
+            self.file.url = ret["urls"][0]
+            self.upload.curl.close()
+        handle.close()
+
+class PasteCache:
+    """
+    Size bounded on-disk cache of paste contents keyed by ID.
+
+    Every entry consists of the content and a JSON file with the validators
+    (ETag, Last-Modified) sent by the server and the time of the last check.
+    The mtime of the content is updated on every use and the least recently
+    used entries are evicted once the cache grows bigger than maxsize.
+    """
+    ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def cacheable(self, id):
+        return self.ID_PATTERN.match(id) is not None
+
+    def _path(self, id):
+        return os.path.join(self.directory, id)
+
+    def lookup(self, id):
+        """
+        Returns:
+            Metadata dict of the entry or None if there is none
+        """
+        try:
+            with open(self._path(id) + ".json") as fh:
+                meta = json.load(fh)
+            os.utime(self._path(id))
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def read(self, id, writefunction):
+        with open(self._path(id), 'rb') as fh:
+            for block in iter(lambda: fh.read(1024*1024), b''):
+                writefunction(block)
+
+    def create_temp(self):
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix=".tmp-", delete=False)
+
+    def store(self, id, tmpPath, meta):
+        self._write_meta(id, meta)
+        os.replace(tmpPath, self._path(id))
+        self.evict(last=id)
+
+    def update(self, id, meta):
+        self._write_meta(id, meta)
+
+    def _write_meta(self, id, meta):
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, prefix=".tmp-", delete=False) as fh:
+            json.dump(meta, fh)
+        os.replace(fh.name, self._path(id) + ".json")
+
+    def invalidate(self, id):
+        for path in (self._path(id), self._path(id) + ".json"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, last=None):
+        """
+        Remove the least recently used entries until the cache is no bigger
+        than maxsize. The entry last is only removed if that is not enough.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith('.') or entry.name.endswith('.json'):
+                    continue
+                st = entry.stat()
+                entries.append((entry.name == last, st.st_mtime, st.st_size, entry.name))
+
+        total = sum(size for isLast, mtime, size, name in entries)
+        for isLast, mtime, size, name in sorted(entries):
+            if total <= self.maxsize:
+                break
+            self.invalidate(name)
+            total -= size
+
+class DirectoryManifest:
+    """
+    Remember the size, mtime, SHA-256 and paste ID of every file below a
+    directory so that only changed files need to be uploaded again.
+
+    Files whose size and mtime match the manifest are assumed unchanged
+    without reading them. Others are hashed and, if the content is known
+    from any file in the manifest, its ID is reused.
+    """
+    def __init__(self, path, root):
+        """
+        Args:
+            path: Path of the manifest file
+            root: Directory described by the manifest
+        """
+        self.path = path
+        self.root = root
+        try:
+            with open(path) as fh:
+                self.files = json.load(fh)["files"]
+        except (OSError, ValueError, KeyError):
+            self.files = {}
+
+    @staticmethod
+    def scan(root, prefix=""):
+        """
+        Yield (relative path, os.DirEntry) of all regular files below root
+        sorted by path. Symlinks to directories are not followed.
+        """
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            relpath = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                yield from DirectoryManifest.scan(entry.path, relpath + "/")
+            elif entry.is_file():
+                yield relpath, entry
+
+    @staticmethod
+    def hash_file(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1024*1024), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def diff(self):
+        """
+        Returns:
+            List of (relative path, path, record) for all files below root.
+            record contains size, mtime_ns, sha256 and the paste ID or None
+            if the file has to be uploaded.
+        """
+        byHash = {record["sha256"]: record["id"] for record in self.files.values()}
+        result = []
+        for relpath, entry in self.scan(self.root):
+            st = entry.stat()
+            old = self.files.get(relpath)
+            if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                record = dict(old)
+            else:
+                sha256 = self.hash_file(entry.path)
+                record = {
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "sha256": sha256,
+                    "id": byHash.get(sha256),
+                    }
+            result.append((relpath, entry.path, record))
+        return result
+
+    def save(self, files):
+        self.files = files
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path), prefix=".tmp-", delete=False) as fh:
+            json.dump({"files": files}, fh)
+        os.replace(fh.name, self.path)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+class MultipasteBuilder:
+    """
+    Create multipastes of any number of IDs.
+
+    The server limits the number of form fields per request and only
+    accepts file IDs in a multipaste. If there are more IDs than fit into
+    one request, a multipaste is created for each consecutive chunk. IDs
+    may be added while uploads are still running; every full chunk is sent
+    right away so only the last request remains once the last IDs are
+    known.
+    """
+    def __init__(self, curlw, count):
+        """
+        Args:
+            curlw: CURLWrapper to send the requests with
+            count: Expected number of IDs
+        """
+        self.curlw = curlw
+        self.chunksize = max(count, 1)
+        if count > curlw.config["min_variables_per_request_default"]:
+            # leave space for the api key and the minimum ID length
+            self.chunksize = curlw.getServerConfig()["max_input_vars"] - 2
+        self.pending = []
+        self.parts = []
+
+    def _create(self, ids):
+        data = []
+        for id in ids:
+            data.append({"ids["+id+"]": id})
+        return self.curlw.send_post("/file/create_multipaste", data)
+
+    def add(self, ids):
+        self.pending += ids
+        while len(self.pending) >= self.chunksize:
+            self.parts.append(self._create(self.pending[:self.chunksize]))
+            self.pending = self.pending[self.chunksize:]
+
+    def finish(self):
+        """
+        Returns:
+            List of the responses of the requests that created the
+            multipastes in the order of the IDs
+        """
+        if self.pending:
+            self.parts.append(self._create(self.pending))
+            self.pending = []
+        return self.parts
+
 class ProgressBar:
 
     def __init__(self):
@@ -424,20 +1311,289 @@ class ProgressBar:
 
 class Compressor:
     @staticmethod
-    def gzip(src, dst):
+    def gzip(src, dst, level=9):
         dst += '.gz'
-        with open(src, 'rb') as f_in, gzip.open(dst, 'wb') as f_out:
+        with open(src, 'rb') as f_in, gzip.open(dst, 'wb', compresslevel=level) as f_out:
             f_out.writelines(f_in)
         return dst
 
     @staticmethod
-    def xz(src, dst):
+    def xz(src, dst, level=6):
         dst += '.xz'
-        with open(src, 'rb') as f_in, lzma.open(dst, 'wb') as f_out:
+        with open(src, 'rb') as f_in, lzma.open(dst, 'wb', preset=level) as f_out:
             f_out.writelines(f_in)
         return dst
 
 
+class TarBuilder:
+    """
+    Create reproducible tarballs so that uploading the same tree again
+    results in the same file, which the server deduplicates.
+
+    Directories are walked with os.scandir in sorted order and owner,
+    group, mtime and permissions of all entries are normalized. Each
+    compression format always uses the same encoder so that the output only
+    depends on the input: gz and xz are compressed in-process, zst with the
+    zstd tool, which is multithreaded and required for it.
+    """
+    EXTENSIONS = {
+        "none": ".tar",
+        "gz": ".tar.gz",
+        "xz": ".tar.xz",
+        "zst": ".tar.zst",
+        }
+
+    COMMANDS = {
+        "zst": lambda level: ["zstd", "-T0", "-%d" % level, "-q", "-c"],
+        }
+
+    def __init__(self, compression="none", level=None, mtime=None, bufsize=1024*1024):
+        """
+        Args:
+            compression: One of EXTENSIONS' keys
+            level: Compression level
+            mtime: Timestamp of all entries. Defaults to $SOURCE_DATE_EPOCH or 0
+            bufsize: Size of the buffers used for reading and writing
+        """
+        if mtime is None:
+            mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+        self.compression = compression
+        self.level = level
+        self.mtime = mtime
+        self.bufsize = bufsize
+
+    def create(self, dst, paths):
+        """
+        Write a tarball containing paths to dst.
+
+        Returns:
+            Path of the tarball (dst with the extension appended)
+        """
+        dst += self.EXTENSIONS[self.compression]
+        with open(dst, 'wb') as fh, self._compressed(fh) as stream:
+            with tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT,
+                              bufsize=self.bufsize, copybufsize=self.bufsize) as tar:
+                for path in paths:
+                    self._add(tar, path, path)
+        return dst
+
+    @contextlib.contextmanager
+    def _compressed(self, fh):
+        if self.compression == "none":
+            yield fh
+            return
+
+        if self.compression == "gz":
+            with gzip.GzipFile(filename="", mode='wb', fileobj=fh, compresslevel=self.level, mtime=0) as stream:
+                yield stream
+            return
+        elif self.compression == "xz":
+            with lzma.LZMAFile(fh, 'wb', preset=self.level) as stream:
+                yield stream
+            return
+
+        argv = self.COMMANDS[self.compression](self.level)
+        if shutil.which(argv[0]) is None:
+            raise APIException("%s is required for %s compression" % (argv[0], self.compression),
+                    "client-internal/compression-failed")
+        p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=fh, bufsize=self.bufsize)
+        try:
+            yield p.stdin
+        finally:
+            p.stdin.close()
+            ret = p.wait()
+        if ret != 0:
+            raise APIException("%s failed with exit code %d" % (argv[0], ret),
+                    "client-internal/compression-failed")
+
+    def _normalize(self, info):
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        info.mtime = self.mtime
+        if info.issym():
+            info.mode = 0o777
+        elif info.isdir() or info.mode & 0o111:
+            info.mode = 0o755
+        else:
+            info.mode = 0o644
+        return info
+
+    def _add(self, tar, path, arcname):
+        info = tar.gettarinfo(path, arcname)
+        if info is None:
+            # sockets and the like can not be archived
+            return
+        self._normalize(info)
+
+        if info.isreg():
+            with open(path, 'rb', buffering=self.bufsize) as fh:
+                tar.addfile(info, fh)
+        else:
+            tar.addfile(info)
+
+        if info.isdir():
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                self._add(tar, entry.path, os.path.join(arcname, entry.name))
+
+
+class Clipboard:
+    """
+    Backends to copy content into the clipboard. They are registered in
+    BACKENDS and selected with the clipboard_backend setting.
+    """
+    @staticmethod
+    def command(argv, content, target):
+        """ Run the clipboard command and wait for it to finish. """
+        try:
+            with open('/dev/null', 'w') as devnull:
+                p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+                p.communicate(input=content.encode('utf-8'))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+    @staticmethod
+    def detach(argv, content, target):
+        """
+        Run the clipboard command in a double forked process so that we
+        neither wait for it nor leave a zombie behind.
+        """
+        pid = os.fork()
+        if pid > 0:
+            os.waitpid(pid, 0)
+            return
+
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                # don't keep our stdout open, scripts reading it would wait for us
+                devnull = os.open('/dev/null', os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                Clipboard.command(argv, content, target)
+        finally:
+            os._exit(0)
+
+    @staticmethod
+    def osc52(argv, content, target):
+        """
+        Ask the terminal to set the clipboard using the OSC 52 escape
+        sequence. This works over SSH and does not need any other process.
+        """
+        selection = 'p' if target == 'primary' else 'c'
+        data = base64.b64encode(content.encode('utf-8')).decode('ascii')
+        try:
+            with open('/dev/tty', 'w') as tty:
+                tty.write("\033]52;%s;%s\a" % (selection, data))
+        except OSError:
+            # no controlling terminal
+            return
+
+    BACKENDS = {
+        'command': command.__func__,
+        'detach': detach.__func__,
+        'osc52': osc52.__func__,
+    }
+
+
+class InotifyWatcher:
+    """
+    Report files in a directory that have been written and closed or moved
+    into it using inotify(7).
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, path):
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), path)
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds (forever if None) for files.
+
+        Returns:
+            List of paths of finished files
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if name:
+                paths.append(os.path.join(self.path, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Report new or modified files in a directory by periodically comparing
+    their size and mtime.
+    """
+    # don't rescan the directory in a busy loop if watch_delay is 0
+    MIN_INTERVAL = 0.5
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = max(interval, self.MIN_INTERVAL)
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    snapshot[entry.path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+
+        snapshot = self._scan()
+        paths = [path for path, stat in snapshot.items() if self.snapshot.get(path) != stat]
+        self.snapshot = snapshot
+        return paths
+
+    def close(self):
+        pass
+
+def create_watcher(path, interval):
+    try:
+        return InotifyWatcher(path)
+    except (AttributeError, OSError):
+        # no inotify support (e.g. not on Linux)
+        return PollingWatcher(path, interval)
+
+
+class ConfigException(ValueError):
+    pass
+
 class ConfigConstraint():
     def __init__(self, cvar: str, match: str, pattern: typing.Any, enforce: bool = False):
         self.cvar: str = cvar
@@ -445,62 +1601,206 @@ class ConfigConstraint():
         self.pattern: typing.Any = pattern
         self.enforce: bool = enforce
 
-    def validate(self, input: str) -> bool:
+    def validate(self, input: typing.Any) -> bool:
         result = False
         if self.match == 'enum' and (isinstance(self.pattern, tuple) or
                                      isinstance(self.pattern, list)):
             result = input in self.pattern
-            if self.enforce:
-                print(f"Invalid config setting for {self.cvar}: '{input}', " \
-                       "allowed: '{self.pattern}' ({self.match})", file=sys.stderr)
-                raise ValueError(f'Invalid {self.cvar} config setting: {input}')
+        elif self.match == 'range' and isinstance(self.pattern, tuple):
+            lower, upper = self.pattern
+            result = (lower is None or input >= lower) and (upper is None or input <= upper)
+
+        if not result and self.enforce:
+            raise ConfigException(self.describe(input))
         return result
 
+    def describe(self, input: typing.Any) -> str:
+        if self.match == 'enum':
+            allowed = ', '.join(f"'{x}'" for x in self.pattern)
+        elif self.pattern[0] is None:
+            allowed = f"at most {self.pattern[1]}"
+        elif self.pattern[1] is None:
+            allowed = f"at least {self.pattern[0]}"
+        else:
+            allowed = f"{self.pattern[0]} to {self.pattern[1]}"
+        return f"Invalid config setting for {self.cvar}: '{input}', allowed: {allowed}"
+
+
+class ConfigOption():
+    BOOLEANS = {
+        '1': True, 'yes': True, 'true': True, 'on': True,
+        '0': False, 'no': False, 'false': False, 'off': False,
+    }
+
+    def __init__(self, name: str, type: type, default: typing.Any, constraint: typing.Optional[ConfigConstraint] = None):
+        self.name: str = name
+        self.type: type = type
+        self.default: typing.Any = default
+        self.constraint: typing.Optional[ConfigConstraint] = constraint
+
+    @property
+    def enforce(self) -> bool:
+        return self.constraint is not None and self.constraint.enforce
+
+    @property
+    def env(self) -> str:
+        return "FB_" + self.name.upper()
+
+    def convert(self, input: typing.Any) -> typing.Any:
+        """
+        Convert a value to the type of this option and validate it.
+
+        Raises:
+            ConfigException: The value is not valid for this option
+        """
+        value = input
+        if isinstance(input, str) and self.type is not str:
+            try:
+                if self.type is bool:
+                    value = self.BOOLEANS[input.lower()]
+                else:
+                    value = self.type(input)
+            except (KeyError, ValueError):
+                raise ConfigException(f"Invalid config setting for {self.name}: '{input}', "
+                                      f"expected {self.type.__name__}")
+
+        if self.constraint is not None and not self.constraint.validate(value):
+            raise ConfigException(self.constraint.describe(value))
+        return value
+
 
 class ConfigParser:
+    """
+    Load the configuration from the defaults, the config file, FB_*
+    environment variables and overrides (in increasing priority).
 
-    MATCHER = re.compile('^(?P<key>[^=]+)=(?P<quotechar>[\'"]?)(?P<value>.+)(?P=quotechar)$')
+    The key/value pairs read from the config file are cached in
+    $XDG_CACHE_HOME/fb-client/config.cache until the file changes.
+    """
 
-    CONSTRAINTS = {
-        'clipboard_target': ConfigConstraint('clipboard_target', 'enum', ('none', 'off', 'default', 'primary', 'clipboard'))
-    }
+    MATCHER = re.compile('^(?P<key>[^=]+)=(?P<quotechar>[\'"]?)(?P<value>.+)(?P=quotechar)$')
 
-    def __init__(self, file, ignoreMissing=False):
-        self.config = {}
-        self.config["pastebin"] = "https://paste.xinu.at"
-        self.config["clipboard_target"] = "default"
-        self.config["clipboard_cmd"] = X11_CLIPBOARD_CMD
+    # bump this when the format of the cache changes
+    CACHE_VERSION = 1
+
+    OPTIONS = {option.name: option for option in [
+        ConfigOption('pastebin', str, "https://paste.xinu.at"),
+        ConfigOption('clipboard_target', str, "default",
+                     ConfigConstraint('clipboard_target', 'enum', ('none', 'off', 'default', 'primary', 'clipboard'))),
+        ConfigOption('clipboard_cmd', str, X11_CLIPBOARD_CMD),
+        ConfigOption('clipboard_backend', str, "command",
+                     ConfigConstraint('clipboard_backend', 'enum', tuple(Clipboard.BACKENDS.keys()))),
+        ConfigOption('apikey_file', str, os.path.join(xdg.BaseDirectory.xdg_config_home, "fb-client/apikey")),
+        ConfigOption('warnsize', int, 10*1024*1024,
+                     ConfigConstraint('warnsize', 'range', (0, None))),
+        ConfigOption('min_files_per_request_default', int, 5,
+                     ConfigConstraint('min_files_per_request_default', 'range', (1, None))),
+        ConfigOption('min_variables_per_request_default', int, 20,
+                     ConfigConstraint('min_variables_per_request_default', 'range', (2, None))),
+        ConfigOption('gzip_level', int, 9,
+                     ConfigConstraint('gzip_level', 'range', (0, 9))),
+        ConfigOption('xz_level', int, 6,
+                     ConfigConstraint('xz_level', 'range', (0, 9))),
+        ConfigOption('zstd_level', int, 3,
+                     ConfigConstraint('zstd_level', 'range', (1, 19))),
+        ConfigOption('tar_compression', str, "default",
+                     ConfigConstraint('tar_compression', 'enum', ('default', 'none', 'gz', 'xz', 'zst'))),
+        ConfigOption('connect_timeout', int, 0,
+                     ConfigConstraint('connect_timeout', 'range', (0, None))),
+        ConfigOption('timeout', int, 0,
+                     ConfigConstraint('timeout', 'range', (0, None))),
+        ConfigOption('limit_rate', int, 0,
+                     ConfigConstraint('limit_rate', 'range', (0, None))),
+        ConfigOption('limit_burst', int, 0,
+                     ConfigConstraint('limit_burst', 'range', (0, None))),
+        ConfigOption('limit_shared', bool, False),
+        ConfigOption('concurrency', int, 4,
+                     ConfigConstraint('concurrency', 'range', (1, None))),
+        ConfigOption('stream_buffer_size', int, 1024*1024,
+                     ConfigConstraint('stream_buffer_size', 'range', (16*1024, None))),
+        ConfigOption('cache_max_size', int, 100*1024*1024,
+                     ConfigConstraint('cache_max_size', 'range', (0, None))),
+        ConfigOption('cache_ttl', int, 3600,
+                     ConfigConstraint('cache_ttl', 'range', (0, None))),
+        ConfigOption('split_max_size', int, 0,
+                     ConfigConstraint('split_max_size', 'range', (0, None))),
+        ConfigOption('watch_delay', float, 2.0,
+                     ConfigConstraint('watch_delay', 'range', (0.0, None))),
+    ]}
+
+    def __init__(self, file, ignoreMissing=False, overrides={}):
+        self.config = {name: option.default for name, option in self.OPTIONS.items()}
         if os.uname()[0] == "Darwin":
             self.config["clipboard_cmd"] = DARWIN_CLIPBOARD_CMD
         elif os.environ.get('XDG_SESSION_TYPE') == 'wayland':
             self.config["clipboard_cmd"] = WAYLAND_CLIPBOARD_CMD
-        self.config["apikey_file"] = os.path.join(xdg.BaseDirectory.xdg_config_home, "fb-client/apikey")
 
-        self._parse(file, ignoreMissing=ignoreMissing)
-        self._validate()
+        for key, value in self._load(file, ignoreMissing=ignoreMissing).items():
+            self._set(key, value, file)
+
+        for name, option in self.OPTIONS.items():
+            if option.env in os.environ:
+                self._set(name, os.environ[option.env], option.env)
+
+        for key, value in overrides.items():
+            self._set(key, value, "command line", strict=True)
 
         self.config["apikey_file"] = os.path.expandvars(self.config["apikey_file"])
 
-    def _validate(self):
-        for cvar, constraint in self.CONSTRAINTS.items():
-            if not constraint.validate(self.config[cvar]):
-                print(f"WARN: ignoring invalid config setting: '{cvar}'", file=sys.stderr)
-                del self.config[cvar]
+    def _set(self, key, value, source, strict=False):
+        option = self.OPTIONS.get(key)
+        if option is None:
+            if strict:
+                raise ConfigException(f"Unknown config setting: {key} (from {source})")
+            self.config[key] = value
+            return
 
-    def _parse(self, file, ignoreMissing=False):
         try:
-            fh = open(file)
-        except IOError as e:
-            if ignoreMissing:
-                if e.errno == errno.ENOENT:
-                    return
+            self.config[key] = option.convert(value)
+        except ConfigException as e:
+            if strict or option.enforce:
+                raise ConfigException(f"{e} (from {source})")
+            print(f"WARN: ignoring invalid config setting from {source}: {e}", file=sys.stderr)
+
+    def _load(self, file, ignoreMissing=False):
+        try:
+            st = os.stat(file)
+        except OSError as e:
+            if ignoreMissing and e.errno == errno.ENOENT:
+                return {}
             raise
 
-        with fh:
+        cacheFile = os.path.join(xdg.BaseDirectory.xdg_cache_home, "fb-client/config.cache")
+        cacheKey = (self.CACHE_VERSION, os.path.abspath(file), st.st_mtime_ns, st.st_size)
+        try:
+            with open(cacheFile, 'rb') as fh:
+                cache = pickle.load(fh)
+            if cache["key"] == cacheKey:
+                return cache["values"]
+        except Exception:
+            # missing, outdated or broken cache
+            pass
+
+        values = self._parse(file)
+
+        try:
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(cacheFile), delete=False) as fh:
+                pickle.dump({"key": cacheKey, "values": values}, fh)
+            os.replace(fh.name, cacheFile)
+        except OSError:
+            pass
+
+        return values
+
+    def _parse(self, file):
+        values = {}
+        with open(file) as fh:
             for line in fh:
                 matches = self.MATCHER.match(line)
                 if matches != None:
-                    self.config[matches.group('key')] = matches.group('value')
+                    values[matches.group('key')] = matches.group('value')
+        return values
 
     def get_config(self):
         return self.config
@@ -518,6 +1818,7 @@ class FBClient:
             "create_apikey",
             "display_version",
             "display_history",
+            "watch",
             ])
 
     def __init__(self):
@@ -531,14 +1832,32 @@ class FBClient:
         else:
             self.parseConfig(self.args.config)
 
+    def getConfigOverrides(self):
+        overrides = {}
+        for option in self.args.options:
+            key, sep, value = option.partition("=")
+            if not sep:
+                raise ConfigException(f"Invalid option '{option}', expected NAME=VALUE")
+            overrides[key] = value
+
+        # dedicated command line switches take precedence over -o
+        for key in ("limit_rate", "limit_burst", "limit_shared", "watch_delay"):
+            if getattr(self.args, key) is not None:
+                overrides[key] = getattr(self.args, key)
+        return overrides
+
     def parseConfig(self, file, ignoreMissing=False):
-        c = ConfigParser(file, ignoreMissing=ignoreMissing)
+        c = ConfigParser(file, ignoreMissing=ignoreMissing, overrides=self.getConfigOverrides())
         self.config = c.get_config()
-        self.config["warnsize"] = 10*1024*1024
-        self.config["min_files_per_request_default"] = 5
-        self.config["min_variables_per_request_default"] = 20
         self.config["useragent"] = "fb-client/%s" % self.version
 
+        self.limiter = None
+        if self.config["limit_rate"] > 0:
+            statefile = None
+            if self.config["limit_shared"]:
+                statefile = BandwidthLimiter.get_statefile()
+            self.limiter = BandwidthLimiter(self.config["limit_rate"], self.config["limit_burst"], statefile)
+
         # this needs to be at the end because during handling of the exception
         # the values above are used
         try:
@@ -572,6 +1891,18 @@ class FBClient:
                 help="Use different config file")
         parser.add_argument("-D", "--debug", default=False, action="store_true",
                 help="Enable debug output")
+        parser.add_argument("--output", default="text", action="store", choices=("text", "json", "ndjson"),
+                help="Output format (default: text)")
+        parser.add_argument("--json", dest="output", action="store_const", const="json",
+                help="Same as --output json")
+        parser.add_argument("-o", "--option", dest="options", default=[], action="append", metavar="NAME=VALUE",
+                help="Override a config file setting")
+        parser.add_argument("--limit-rate", default=None, action="store", type=int, metavar="BYTES",
+                help="maximum combined speed of all transfers in bytes/s (default: unlimited = 0)")
+        parser.add_argument("--limit-burst", default=None, action="store", type=int, metavar="BYTES",
+                help="number of bytes that may be transferred at once above the rate limit (default: one second worth)")
+        parser.add_argument("--limit-shared", default=None, action="store_true",
+                help="share the rate limit with all other fb processes of this user")
 
         upload_options = parser.add_argument_group('upload options')
         upload_options.add_argument("-t", "--tar", default=False, action="store_true",
@@ -586,6 +1917,18 @@ class FBClient:
                 help="minimum length for the generated ID in the paste url")
         upload_options.add_argument("--upload-speed", default=0, action="store", type=int,
                 help="maximum upload speed in bytes/s (default: unlimited = 0)")
+        upload_options.add_argument("--split", default=False, action="store_true",
+                help="Upload files that are too big for the server in parts")
+        upload_options.add_argument("-i", "--incremental", default=False, action="store_true",
+                help="Upload the files in directories separately and only those changed since the last upload")
+
+        watch_options = parser.add_argument_group('watch options')
+        watch_options.add_argument("--watch", default=None, action="store", metavar="DIR",
+                help="Continuously upload new or changed files in DIR")
+        watch_options.add_argument("--watch-delay", default=None, action="store", type=float, metavar="SECONDS",
+                help="Upload once no file has changed for this long (default: 2)")
+        watch_options.add_argument("--watch-log", default=None, action="store", metavar="FILE",
+                help="Append the URLs of uploaded files to FILE")
 
         parser.add_argument("-c", "--compress", default=0, action="count",
                 help="Compress the file being uploaded with gz or xz if used 2 times. "
@@ -595,6 +1938,16 @@ class FBClient:
 
         self.args = parser.parse_args()
 
+        if self.args.watch is not None:
+            if self.args.mode not in (None, self.modes.upload):
+                parser.error("--watch can only be used when uploading")
+            if self.args.tar:
+                parser.error("--watch does not support --tar")
+            self.args.mode = self.modes.watch
+
+        if self.args.incremental and self.args.tar:
+            parser.error("--incremental does not support --tar")
+
         try:
             self.loadConfig()
         except ApikeyNotFoundException:
@@ -602,7 +1955,7 @@ class FBClient:
                 if sys.stdin.isatty():
                     eprint("No API key found, creating a new one")
                     self.config["debug"] = self.args.debug
-                    self.curlw = CURLWrapper(self.config, self.args)
+                    self.curlw = CURLWrapper(self.config, self.args, self.limiter)
                     self.create_apikey()
                     self.curlw = None
                     self.loadConfig()
@@ -612,7 +1965,7 @@ class FBClient:
 
         self.config["debug"] = self.args.debug
 
-        self.curlw = CURLWrapper(self.config, self.args)
+        self.curlw = CURLWrapper(self.config, self.args, self.limiter)
 
         functions = {
                 self.modes.upload: self.upload,
@@ -621,15 +1974,20 @@ class FBClient:
                 self.modes.create_apikey: self.create_apikey,
                 self.modes.display_version: self.display_version,
                 self.modes.display_history: self.display_history,
+                self.modes.watch: self.watch,
                 }
         if not self.args.mode:
             self.args.mode = self.modes.upload
 
+        self.output = Output(self.args.output)
         with make_temp_directory() as self.tempdir:
-            functions[self.args.mode]()
+            try:
+                functions[self.args.mode]()
+            finally:
+                self.output.close()
 
     def handle_ctrl_c(self, signal, frame):
-        print("\nReceived signal, aborting!")
+        eprint("\nReceived signal, aborting!")
         sys.exit(1)
 
     def makedirs(self, path):
@@ -649,32 +2007,45 @@ class FBClient:
     def handle_compression(self, file):
         if self.args.compress > 0:
             compressor = {
-                1: Compressor.gzip,
-                2: Compressor.xz,
+                1: (Compressor.gzip, self.config["gzip_level"]),
+                2: (Compressor.xz, self.config["xz_level"]),
             }
-            return compressor[self.args.compress](file, self.create_temp_copy_path(file))
+            compress, level = compressor[self.args.compress]
+            return compress(file, self.create_temp_copy_path(file), level)
         else:
             return file
 
     def handle_directory(self, path):
         if os.path.isdir(path):
-            return self.create_tarball(path)
+            return self.create_tarball([path], self.args.name)
 
         return path
 
-    def create_tarball(self, path):
-        compression = {
-                0: "",
-                1: "gz",
-                2: "xz",
-                }
-        extension = "." + '.'.join(["tar", compression[self.args.compress]])
-        tarball_path = os.path.normpath(self.tempdir + "/" + self.args.name + extension)
-        tar = tarfile.open(tarball_path, "w:" + compression[self.args.compress])
-        tar.add(path)
-        tar.close()
+    def create_tarball(self, paths, name):
+        """
+        Pack paths into a reproducible tarball in the temporary directory.
+
+        The compression is selected with the tar_compression setting or,
+        by default, the number of -c flags.
 
-        return tarball_path
+        Returns:
+            Path of the tarball
+        """
+        compression = self.config["tar_compression"]
+        if compression == "default":
+            compression = {
+                    0: "none",
+                    1: "gz",
+                    2: "xz",
+                    }[self.args.compress]
+        level = {
+                "none": None,
+                "gz": self.config["gzip_level"],
+                "xz": self.config["xz_level"],
+                "zst": self.config["zstd_level"],
+                }[compression]
+        tarball_path = os.path.normpath(self.tempdir + "/" + name)
+        return TarBuilder(compression, level).create(tarball_path, paths)
 
 
     def create_temp_copy(self, file):
@@ -700,29 +2071,172 @@ class FBClient:
                     file.path = self.create_temp_copy(file.path)
 
                 if os.path.isdir(file.path):
-                    file.path = self.create_tarball(file.path)
-                else:
-                    file.path = self.handle_compression(file.path)
+                    file.path = self.create_tarball([file.path], self.args.name)
+                elif not file.compressed:
+                    compressed = self.handle_compression(file.path)
+                    if file.name is not None:
+                        # keep the extension added by the compression
+                        file.name += os.path.basename(compressed)[len(os.path.basename(file.path)):]
+                    file.path = compressed
 
             upload_files.append(file)
 
-        if len(upload_files) == 1 and not upload_files[0].should_upload():
+        manifests = []
+        if self.args.split:
+            upload_files, manifests = self.split_large_files(upload_files)
+
+        if len(upload_files) == 1 and not upload_files[0].should_upload() and upload_files[0].url is None:
             filename = None
             if self.args.name != FBClient.DEFAULT_NAME:
                 filename = self.args.name
             upload_files[0] = self.url_to_file(self.config['pastebin']+'/'+upload_files[0].id, filename)
 
-        resp = self.curlw.upload_files(upload_files)
+        urls = self.upload_and_report(upload_files, self.args.multipaste or len(upload_files) > 1)
+        if self.output.text:
+            for url in urls:
+                print(url)
+        for filename, manifest in manifests:
+            eprint("Reassemble %s with: fb -g %s" % (filename, manifest.url))
+        self.setClipboard(' '.join(urls))
 
-        if self.args.multipaste or len(resp) > 1:
-            resp = self.multipaste([f.id for f in resp])
-            urls = [resp["url"]]
-        else:
-            urls = [f.url for f in resp]
+    def upload_and_report(self, files, multipaste):
+        """
+        Upload files, optionally combine them into a multipaste and emit a
+        record for every file as soon as it and all files before it have
+        been uploaded.
 
-        for url in urls:
-            print(url)
-        self.setClipboard(' '.join(urls))
+        Returns:
+            List of the URLs to display
+        """
+        builder = None
+        if multipaste:
+            builder = MultipasteBuilder(self.curlw, len(files))
+
+        done = 0
+        def files_done():
+            # the multipaste and the output keep the order of the files
+            nonlocal done
+            while done < len(files) and files[done].id is not None:
+                file = files[done]
+                self.output.emit({
+                    "type": "file",
+                    "id": file.id,
+                    "url": file.url or "%s/%s/" % (self.config["pastebin"], file.id),
+                    })
+                if builder is not None:
+                    builder.add([file.id])
+                done += 1
+            self.output.flush()
+
+        resp = self.curlw.upload_files(files, files_done)
+        files_done()
+
+        if builder is None:
+            return [f.url for f in resp]
+
+        multipastes = builder.finish()
+        if len(multipastes) > 1:
+            eprint("The server accepts at most %d files per multipaste, created %d multipastes"
+                   % (builder.chunksize, len(multipastes)))
+        for resp in multipastes:
+            self.output.emit({"type": "multipaste", "id": resp["url_id"], "url": resp["url"]})
+        self.output.flush()
+        return [resp["url"] for resp in multipastes]
+
+    def split_large_files(self, files):
+        """
+        Replace files that are bigger than the server allows by their parts
+        and a manifest that lists them.
+
+        Returns:
+            Tuple of the new list of files and a list of (file name,
+            manifest file) tuples
+        """
+        result = []
+        manifests = []
+        for file in files:
+            if file.should_upload() and os.stat(file.path).st_size > self.config["warnsize"] \
+                    and os.stat(file.path).st_size > self.curlw.getServerConfig()["upload_max_size"]:
+                parts, manifest = self.split_file(file.path)
+                result += parts
+                result.append(manifest)
+                manifests.append((os.path.basename(file.path), manifest))
+            else:
+                result.append(file)
+        return result, manifests
+
+    def split_file(self, path):
+        """
+        Upload a file in content defined parts and create a manifest for
+        reassembling it with -g.
+
+        Returns:
+            Tuple of the list of uploaded parts and the manifest file that
+            still has to be uploaded
+        """
+        sc = self.curlw.getServerConfig()
+        # leave some space for the other form fields
+        maxsize = min(sc["upload_max_size"], sc["request_max_size"] - 64*1024)
+        if self.config["split_max_size"] > 0:
+            maxsize = min(maxsize, self.config["split_max_size"])
+
+        filename = os.path.basename(path)
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            # parts are uploaded while the rest of the file is still being
+            # split, so their content is usually read from the page cache
+            chunks = content_defined_chunks(fh, maxsize // 16, maxsize // 4, maxsize, total=sha256)
+            if hasattr(pycurl, 'MIMEPOST') and hasattr(pycurl.CurlMimePart, 'data_cb'):
+                parts = self.curlw.upload_parts(path, filename, chunks)
+            else:
+                parts = self.upload_parts_from_files(path, filename, chunks)
+
+        manifest = collections.OrderedDict()
+        manifest["fb-split-manifest"] = 1
+        manifest["filename"] = filename
+        manifest["size"] = sum(part["size"] for part in parts)
+        manifest["sha256"] = sha256.hexdigest()
+        manifest["parts"] = [{"id": p["id"], "size": p["size"], "sha256": p["sha256"]} for p in parts]
+
+        manifestPath = os.path.join(tempfile.mkdtemp(dir=self.tempdir), filename + ".manifest.json")
+        with open(manifestPath, 'w') as fh:
+            json.dump(manifest, fh)
+
+        uploaded = []
+        for part in parts:
+            file = File(id=part["id"])
+            file.url = part["url"]
+            uploaded.append(file)
+
+        return uploaded, File(manifestPath)
+
+    def upload_parts_from_files(self, path, filename, parts):
+        """
+        Upload parts one at a time by copying each into a temporary file.
+        Used if pycurl can't read uploads from a callback.
+
+        Returns:
+            List of the parts
+        """
+        partdir = tempfile.mkdtemp(dir=self.tempdir)
+        uploaded = []
+        with open(path, 'rb') as fh:
+            for index, part in enumerate(parts):
+                uploaded.append(part)
+                partPath = os.path.join(partdir, "%s.part%03d" % (filename, index + 1))
+                fh.seek(part["offset"])
+                with open(partPath, 'wb') as out:
+                    remaining = part["size"]
+                    while remaining > 0:
+                        data = fh.read(min(remaining, 1024*1024))
+                        out.write(data)
+                        remaining -= len(data)
+
+                file, = self.curlw.upload_files([File(partPath)])
+                part["id"] = file.id
+                part["url"] = file.url
+                os.unlink(partPath)
+        return uploaded
 
     def setClipboard(self, content):
         cmd = self.config['clipboard_cmd']
@@ -736,24 +2250,10 @@ class FBClient:
         elif target == 'clipboard':
             if cmd == X11_CLIPBOARD_CMD:
                 args.extend(['-selection', 'clipboard'])
-        try:
-            with open('/dev/null', 'w') as devnull:
-                p = subprocess.Popen([cmd, *args], stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
-                p.communicate(input=content.encode('utf-8'))
-        except OSError as e:
-            if e.errno == errno.ENOENT:
-                return
-            raise
-        except FileNotFoundError:
-            return
 
-    def multipaste(self, ids):
-        data = []
-        for id in ids:
-            data.append({"ids["+id+"]": id})
-
-        resp = self.curlw.send_post("/file/create_multipaste", data)
-        return resp
+        # make sure the URLs are out before we possibly have to wait
+        sys.stdout.flush()
+        Clipboard.BACKENDS[self.config['clipboard_backend']]([cmd, *args], content, target)
 
     def upload(self):
         if self.args.tar:
@@ -762,18 +2262,16 @@ class FBClient:
                     sys.stderr.write("Error: --tar does not support URLs as arguments")
                     return
 
-            tarPath = os.path.join(self.tempdir, 'upload.tar')
-            tar = tarfile.open(tarPath, 'w')
-            for file in self.args.args:
-                tar.add(file)
-            tar.close()
-            self.upload_files([File(tarPath)])
+            name = 'upload' if self.args.name == FBClient.DEFAULT_NAME else self.args.name
+            tarball = File(self.create_tarball(self.args.args, name))
+            tarball.compressed = True
+            self.upload_files([tarball])
             return
 
         if not self.args.args:
             tempfile = os.path.join(self.tempdir, os.path.basename(self.args.name))
             if sys.stdin.isatty():
-                print("^C to exit, ^D to send")
+                eprint("^C to exit, ^D to send")
             f = open(tempfile, "wb")
             try:
                 f.write(sys.stdin.buffer.read())
@@ -784,10 +2282,214 @@ class FBClient:
             self.upload_files([File(tempfile)])
             return
         else:
-            files = [self.containerize_arg(arg) for arg in self.args.args]
-            self.upload_files(files)
+            remote = [arg for arg in self.args.args if self.is_remote_url(arg)]
+            if remote and not self.check_local_files([arg for arg in self.args.args
+                                                      if not re.match('https?://|id://', arg)]):
+                return
+            mirrored = iter(self.mirror_urls(remote))
+            files = []
+            directories = []
+            for arg in self.args.args:
+                if self.is_remote_url(arg):
+                    files.append(next(mirrored))
+                elif self.args.incremental and os.path.isdir(arg):
+                    manifest, entries = self.scan_directory(arg)
+                    directories.append((manifest, entries))
+                    files += [file for relpath, record, file in entries]
+                else:
+                    files.append(self.containerize_arg(arg))
+
+            try:
+                self.upload_files(files)
+            except APIException:
+                # pastes listed in a manifest may have been deleted since
+                for manifest, entries in directories:
+                    if any(not file.should_upload() for relpath, record, file in entries):
+                        manifest.remove()
+                        eprint("Discarded the upload manifest of %s, it may refer to deleted pastes"
+                               % manifest.root)
+                raise
+
+            for manifest, entries in directories:
+                records = {}
+                for relpath, record, file in entries:
+                    if file.id is not None:
+                        record["id"] = file.id
+                        records[relpath] = record
+                manifest.save(records)
+            return
+
+    def check_local_files(self, paths):
+        """
+        Make sure local files can be uploaded before URLs are mirrored so
+        that no pastes are left behind if they can't.
+
+        Returns:
+            False if a file does not exist
+        """
+        for path in paths:
+            if not os.path.exists(path):
+                sys.stderr.write("Error: File \"%s\" is not readable/not found.\n" % path)
+                return False
+
+            # the size of compressed files and tarballs is not known yet
+            if self.args.split or self.args.compress or not os.path.isfile(path):
+                continue
+            filesize = os.stat(path).st_size
+            if filesize > self.config["warnsize"] and filesize > self.curlw.getServerConfig()["upload_max_size"]:
+                raise APIException("File too big: %s (use --split to upload it in parts)" % (path),
+                        "client-internal/file-too-big")
+        return True
+
+    def scan_directory(self, path):
+        """
+        Find the files below path that changed since it was last uploaded
+        with --incremental.
+
+        Returns:
+            (DirectoryManifest, list of (relative path, record, File)).
+            Unchanged files are represented by their existing paste.
+        """
+        key = json.dumps([os.path.realpath(path), self.config["pastebin"], self.args.compress])
+        manifest = DirectoryManifest(os.path.join(xdg.BaseDirectory.xdg_cache_home, "fb-client/dirs",
+                                                  hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json"),
+                                     path)
+
+        # upload files under their path like they would appear in a tarball
+        prefix = os.path.basename(os.path.abspath(path))
+        entries = []
+        for relpath, filepath, record in manifest.diff():
+            if record["id"] is None:
+                file = File(filepath)
+                file.name = prefix + "/" + relpath
+            else:
+                file = File(id=record["id"])
+                file.url = "%s/%s/" % (self.config["pastebin"], record["id"])
+            entries.append((relpath, record, file))
+
+        changed = sum(1 for relpath, record, file in entries if file.should_upload())
+        if self.args.debug:
+            eprint("%s: %d of %d files changed" % (path, changed, len(entries)))
+        return manifest, entries
+
+    def is_remote_url(self, arg):
+        return re.match('https?://', arg) and not arg.startswith(self.config['pastebin'])
+
+    def mirror_urls(self, urls):
+        """
+        Download URLs concurrently and upload their content while it is
+        being downloaded if possible.
+
+        Args:
+            urls: List of URLs
+        Returns:
+            List of File objects in the same order as urls. Files that have
+            already been uploaded have their id set, all others a path.
+        """
+        # compressing needs the whole file
+        stream = self.args.compress == 0 and hasattr(pycurl, 'MIMEPOST') \
+                and hasattr(pycurl.CurlMimePart, 'data_cb')
+
+        results = [None] * len(urls)
+        pending = list(enumerate(urls))
+        running = []
+        multi = pycurl.CurlMulti()
+
+        while pending or running:
+            while pending and len(running) < self.config["concurrency"]:
+                index, url = pending.pop(0)
+                mirror = URLMirror(self.curlw, url, os.path.basename(url.strip("/")), self.tempdir,
+                                   self.config["stream_buffer_size"], stream)
+                multi.add_handle(mirror.download)
+                running.append((index, mirror))
+
+            while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                pass
+
+            while True:
+                queued, succeeded, failed = multi.info_read()
+                for handle, code, errmsg in failed:
+                    raise pycurl.error(code, errmsg)
+                for handle in succeeded:
+                    multi.remove_handle(handle)
+                    for index, mirror in running:
+                        if handle in mirror.handles():
+                            mirror.done(handle)
+                if queued == 0:
+                    break
+
+            changed = False
+            for index, mirror in list(running):
+                if mirror.file is not None:
+                    results[index] = mirror.file
+                    running.remove((index, mirror))
+                elif mirror.update(multi):
+                    changed = True
+
+            if not changed:
+                multi.select(1.0)
+
+        return results
+
+    def watch(self):
+        if not os.path.isdir(self.args.watch):
+            eprint("Error: \"%s\" is not a directory" % self.args.watch)
+            sys.exit(1)
+
+        watcher = create_watcher(self.args.watch, self.config['watch_delay'])
+        # Files are collected until nothing has changed for watch_delay
+        # seconds and then uploaded together.
+        pending = set()
+        lastChange = 0
+        try:
+            while True:
+                timeout = None
+                if pending:
+                    timeout = max(0, lastChange + self.config['watch_delay'] - time.time())
+
+                for path in watcher.poll(timeout):
+                    # skip hidden and temporary files (e.g. from rsync)
+                    if not os.path.basename(path).startswith('.'):
+                        pending.add(path)
+                        lastChange = time.time()
+
+                if pending and time.time() - lastChange >= self.config['watch_delay']:
+                    self.upload_batch(sorted(pending))
+                    pending = set()
+        finally:
+            watcher.close()
+
+    def upload_batch(self, paths):
+        """
+        Upload the files of one watch mode batch and report their URLs.
+
+        Errors are reported, but do not stop the watch loop.
+        """
+        files = []
+        for path in paths:
+            # the file may have been removed again in the meantime
+            if os.path.isfile(path) and os.stat(path).st_size > 0:
+                files.append(File(self.handle_compression(path)))
+        if not files:
             return
 
+        try:
+            urls = self.upload_and_report(files, self.args.multipaste and len(files) > 1)
+        except (APIException, pycurl.error) as e:
+            eprint("Failed to upload %s: %s" % (', '.join(paths), e))
+            return
+        finally:
+            for file in files:
+                if file.path.startswith(self.tempdir):
+                    os.unlink(file.path)
+
+        if self.output.text:
+            for url in urls:
+                print(url, flush=True)
+        if self.args.watch_log is not None:
+            with open(self.args.watch_log, 'a') as log:
+                log.writelines(url + "\n" for url in urls)
+
     def containerize_arg(self, arg):
         if re.match('id://', arg):
             id = arg.replace('id://', '')
@@ -813,11 +2515,154 @@ class FBClient:
         id = match.group(0)
         return id
 
+    def getPasteCache(self):
+        if self.config["cache_max_size"] == 0:
+            return None
+        # IDs are only unique per pastebin
+        pastebin = hashlib.sha256(self.config["pastebin"].encode('utf-8')).hexdigest()[:16]
+        return PasteCache(os.path.join(xdg.BaseDirectory.xdg_cache_home, "fb-client/pastes", pastebin),
+                          self.config["cache_max_size"])
+
+    def fetch(self, id, writefunction):
+        """
+        Write the content of a paste to writefunction. Pastes are served
+        from the cache if they have been checked within cache_ttl seconds,
+        otherwise the cached copy is revalidated with the server.
+
+        Returns:
+            HTTP response code; responses other than 200 and those bigger
+            than the cache are not cached
+        """
+        cache = self.getPasteCache()
+        if cache is None or not cache.cacheable(id):
+            self.curlw.send_get_simple(id, writefunction)
+            return self.curlw.curl.getinfo(pycurl.HTTP_CODE)
+
+        meta = cache.lookup(id)
+        headers = []
+        if meta is not None:
+            if time.time() - meta["checked"] < self.config["cache_ttl"]:
+                cache.read(id, writefunction)
+                return 200
+            if meta.get("etag"):
+                headers.append("If-None-Match: %s" % meta["etag"])
+            if meta.get("last-modified"):
+                headers.append("If-Modified-Since: %s" % meta["last-modified"])
+
+        tmp = cache.create_temp()
+        responseHeaders = {}
+        received = 0
+        passthrough = False
+        def write(data):
+            # content that doesn't fit into the cache is passed on directly
+            nonlocal received, passthrough
+            received += len(data)
+            if not passthrough and (received > cache.maxsize
+                                    or int(responseHeaders.get("content-length", 0)) > cache.maxsize):
+                passthrough = True
+                tmp.flush()
+                with open(tmp.name, 'rb') as fh:
+                    for block in iter(lambda: fh.read(1024*1024), b''):
+                        writefunction(block)
+                tmp.truncate(0)
+            if passthrough:
+                writefunction(data)
+            else:
+                tmp.write(data)
+
+        try:
+            with tmp:
+                httpcode, responseHeaders = self.curlw.send_get_conditional(id, write, headers, responseHeaders)
+
+            if passthrough:
+                if httpcode == 200 and meta is not None:
+                    cache.invalidate(id)
+                return httpcode
+            elif httpcode == 304 and meta is not None:
+                meta["checked"] = time.time()
+                cache.update(id, meta)
+            elif httpcode == 200:
+                cache.store(id, tmp.name, {
+                    "etag": responseHeaders.get("etag"),
+                    "last-modified": responseHeaders.get("last-modified"),
+                    "checked": time.time(),
+                    })
+            else:
+                with open(tmp.name, 'rb') as fh:
+                    writefunction(fh.read())
+                return httpcode
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+
+        cache.read(id, writefunction)
+        return 200
+
     def get(self):
         for arg in self.args.args:
             id = self.extractId(arg)
-            resp = self.curlw.send_get_simple(id)
-            print(resp)
+            if not self.output.text:
+                self.get_metadata(id)
+                continue
+
+            b = BytesIO()
+            self.fetch(id, b.write)
+            resp = b.getvalue().decode("utf-8")
+            if resp.startswith('{"fb-split-manifest"'):
+                self.get_split(json.loads(resp))
+            else:
+                print(resp)
+
+    def get_metadata(self, id):
+        """
+        Emit the size and checksum of a paste instead of its content.
+        """
+        hash = hashlib.sha256()
+        size = 0
+        def write(data):
+            nonlocal size
+            hash.update(data)
+            size += len(data)
+
+        httpcode = self.fetch(id, write)
+        self.output.emit({
+            "type": "paste",
+            "id": id,
+            "url": "%s/%s/" % (self.config["pastebin"], id),
+            "status": httpcode,
+            "size": size,
+            "sha256": hash.hexdigest(),
+            })
+        self.output.flush()
+
+    def get_split(self, manifest):
+        """
+        Output the parts of a file uploaded with --split in order and verify
+        them against the manifest.
+        """
+        sys.stdout.flush()
+        total = hashlib.sha256()
+        size = 0
+        for part in manifest["parts"]:
+            hash = hashlib.sha256()
+            def write(data):
+                hash.update(data)
+                total.update(data)
+                sys.stdout.buffer.write(data)
+
+            httpcode = self.fetch(part["id"], write)
+            if httpcode != 200:
+                raise APIException("Failed to get part %s: HTTP response code %s" % (part["id"], httpcode),
+                        "client-internal/invalid-response")
+            if hash.hexdigest() != part["sha256"]:
+                raise APIException("Part %s of %s is corrupt" % (part["id"], manifest["filename"]),
+                        "client-internal/checksum-mismatch")
+            size += part["size"]
+
+        sys.stdout.buffer.flush()
+        if size != manifest["size"] or total.hexdigest() != manifest["sha256"]:
+            raise APIException("Reassembled %s does not match the manifest" % manifest["filename"],
+                    "client-internal/checksum-mismatch")
 
     def delete(self):
         chunksize = self.config["min_variables_per_request_default"]
@@ -833,60 +2678,122 @@ class FBClient:
                 data.append({"ids["+id+"]": id})
 
             resp = self.curlw.send_post("/file/delete", data)
-            if resp["errors"]:
+
+            cache = self.getPasteCache()
+            if cache is not None:
+                for arg in args:
+                    cache.invalidate(self.extractId(arg))
+
+            if not self.output.text:
+                for item in (resp.get("deleted") or {}).values():
+                    self.output.emit({"type": "deleted", "id": item["id"]})
+                for item in (resp["errors"] or {}).values():
+                    self.output.emit({"type": "error", "id": item["id"], "reason": item["reason"]})
+                self.output.flush()
+            elif resp["errors"]:
                 for item in resp["errors"].values():
                     print("Failed to delete \"%s\": %s" % (item["id"], item["reason"]))
 
 
     def display_history(self):
+        if not self.output.text:
+            self.emit_history()
+            return
+
         timeFormat = '%a, %d %b %Y %H:%M:%S +0000'
-        resp = self.curlw.send_post("/file/history")
 
-        multipasteItems = resp['multipaste_items']
-        if not multipasteItems:
-            multipasteItems = {}
+        # Only keep the columns we display; the items are handed to us one
+        # by one while the response is still being received.
+        rows = []
+        multipasteItems = []
+        fileSizes = dict()
+        uniqueSize = dict()
 
-        items = resp['items']
-        if not items:
-            items = {}
+        def add_item(id, item):
+            filesize = int(item['filesize'])
+            fileSizes[id] = filesize
+            uniqueSize[item['hash']] = filesize
+            rows.append([int(item['date']), item['id'], item['filename'], item['mimetype'], item['hash'], filesize])
 
-        items = list(items.values())
-        multipasteItems = list(multipasteItems.values())
+        def add_multipaste_item(id, item):
+            multipasteItems.append([int(item['date']), item['url_id'], list(item['items'].keys())])
 
-        uniqueSize = dict()
-        for item in items:
-            uniqueSize[item['hash']] = int(item['filesize'])
+        self.curlw.send_post_stream("/file/history", {
+            "items": add_item,
+            "multipaste_items": add_multipaste_item,
+            })
 
         totalSize = sum([v for v in uniqueSize.values()])
+        uploadCount = len(rows)
 
-        for item in multipasteItems:
-            item['id'] = item['url_id']
-            item['filename'] = '%s file(s)' % (len(item['items']))
-            item['mimetype'] = ''
-            item['hash'] = ''
+        for date, url_id, ids in multipasteItems:
             # sum filesize of all items
-            item['filesize'] = str(sum([int(resp['items'][i]['filesize']) for i in item['items'].keys()]))
-            items.append(item)
+            filesize = sum([fileSizes[i] for i in ids])
+            rows.append([date, url_id, '%s file(s)' % (len(ids)), '', '', filesize])
 
-        items.sort(key=lambda s: s['date'])
+        rows.sort(key=lambda s: s[0])
 
         itemsTable = [['ID', 'Filename', 'Mimetype', 'Date', 'Hash', 'Size']]
         itemsTable += [[
-            i['id'],
-            i['filename'],
-            i['mimetype'],
-            datetime.datetime.fromtimestamp(int(i['date'])).strftime(timeFormat),
-            i['hash'],
-            humanize_bytes(int(i['filesize']))
-                ] for i in items]
+            id,
+            filename,
+            mimetype,
+            datetime.datetime.fromtimestamp(date).strftime(timeFormat),
+            hash,
+            humanize_bytes(filesize)
+                ] for date, id, filename, mimetype, hash, filesize in rows]
         print_table(itemsTable)
 
         print("\n")
         print("Total sum of your distinct uploads: %s" % (humanize_bytes(totalSize)))
-        print("Total number of uploads (excluding multipastes): %s" % (len(resp['items'])))
+        print("Total number of uploads (excluding multipastes): %s" % (uploadCount))
         print("Total number of multipastes: %s" % (len(multipasteItems)))
 
+    def emit_history(self):
+        """
+        Emit the history items while the response is being received.
+        """
+        uniqueSize = dict()
+        counts = {"file": 0, "multipaste": 0}
+
+        def emit_item(id, item):
+            uniqueSize[item['hash']] = int(item['filesize'])
+            counts["file"] += 1
+            self.output.emit({
+                "type": "file",
+                "id": item['id'],
+                "filename": item['filename'],
+                "mimetype": item['mimetype'],
+                "date": int(item['date']),
+                "hash": item['hash'],
+                "size": int(item['filesize']),
+                })
+
+        def emit_multipaste_item(id, item):
+            counts["multipaste"] += 1
+            self.output.emit({
+                "type": "multipaste",
+                "id": item['url_id'],
+                "date": int(item['date']),
+                "ids": list(item['items'].keys()),
+                })
+
+        self.curlw.send_post_stream("/file/history", {
+            "items": emit_item,
+            "multipaste_items": emit_multipaste_item,
+            })
+
+        self.output.emit({
+            "type": "summary",
+            "distinct_size": sum(uniqueSize.values()),
+            "uploads": counts["file"],
+            "multipastes": counts["multipaste"],
+            })
+
     def display_version(self):
+        if not self.output.text:
+            self.output.emit({"type": "version", "version": self.version})
+            return
         print(self.version)
 
     def get_input(self, prompt, display=True):
@@ -929,7 +2836,10 @@ class FBClient:
 class File:
     path = None
     id = None
+    url = None
+    name = None
     paste_url = None
+    compressed = False
 
     def __init__(self, path=None, id=None):
         self.path = path
@@ -941,6 +2851,6 @@ class File:
 if __name__ == '__main__':
     try:
         FBClient().run()
-    except APIException as e:
+    except (APIException, ConfigException) as e:
         sys.stderr.write(str(e)+"\n")
         sys.exit(1)